@@ -9,15 +9,12 @@
 # is the formatting of the email subject and preamble.
 #
 import argparse
-import collections
+import concurrent.futures
+import contextlib
 import csv
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
-from io import StringIO
-import locale
+import math
+import operator
 import os
-import smtplib
 import socket
 import sys
 
@@ -33,43 +30,71 @@ import tree
 # email settings:  user-defined content and server information
 import emailsettings
 
-locale.setlocale(locale.LC_ALL, '') # for comma formatting
+# number of concurrent Organizations API lookups when walking the OU tree
+OU_WORKERS = 16
+
+# seconds to wait on the mail server before giving up
+SMTP_TIMEOUT = 30
+
+# billing CSV columns used from each AccountTotal row:  LinkedAccountId,
+# BillingPeriodEndDate, LinkedAccountName, CurrencyCode and CostBeforeTax
+ACCOUNT_TOTAL_FIELDS = operator.itemgetter(2, 6, 9, 23, 24)
 
 def parse_billing_data(billing_data):
   """
   parse the billing data and store it in a hash
 
+  only the AccountTotal rows are needed, and the detailed bill has a row
+  for every line item, so the raw lines go through a cheap bytes substring
+  test for AccountTotal before they are decoded and handed to the CSV
+  parser.  this prefilter only has to keep a superset of the AccountTotal
+  rows (quoted or unquoted):  the record type check on the parsed row is
+  the real filter.
+
+  each kept line is parsed as its own, complete record.  this relies on the
+  AccountTotal rows never containing an embedded newline (which they don't:
+  only line item descriptions do).  a fragment of a multi-line line item
+  that happens to match is parsed on its own, so it can't swallow the next
+  row, and is then dropped by the record type check.
+
   args:
-    billing_data:  CSV object of billing data
+    billing_data:  iterable of the raw (bytes) lines of the billing CSV
 
   returns:
-    user_dict:  dict, keyed by AWS ID, containing name, user total for all
-                services, and currency
+    user_dict:  dict, keyed by AWS ID, of AccountInfo namedtuples containing
+                name, user total for all services, and currency
     currency:   string, currency used (ie: USD)
     month:      billing month (for CSV output)
     year:       billing year  (for CSV output)
   """
-  user_dict = collections.defaultdict(dict)
+  user_dict = dict()
   currency = ''
   month = ''
   year = ''
 
-  for row in billing_data:
+  account_lines = (line.decode('utf-8') for line in billing_data
+                   if b'AccountTotal' in line)
+
+  for line in account_lines:
+    row = next(csv.reader([line]), [])
     if len(row) < 4:
       continue
     if row[3] == 'AccountTotal':
+      acct_num, date, name, acct_currency, total = ACCOUNT_TOTAL_FIELDS(row)
+
       if not currency:
-        currency = row[23]
+        currency = acct_currency
 
       if not month or not year:
-        date = row[6]
         month = date[5:7]
         year = date[0:4]
 
-      acct_num = row[2]
-      user_dict[acct_num]['name'] = row[9]
-      user_dict[acct_num]['total'] = float(row[24])
-      user_dict[acct_num]['currency'] = row[23]
+      user_dict[acct_num] = config.AccountInfo(
+        id=acct_num,
+        name=name,
+        total=float(total),
+        currency=acct_currency
+      )
 
   return user_dict, currency, month, year
 
@@ -91,52 +116,68 @@ def init_tree(aws_id, default_currency):
 
 def populate_tree(tree, user_dict, default_currency):
   """
-  populates the OU-based tree, mapping account/OU to billing data.  if users
-  are in the bill, but not in the AWS org (due to leaving), the left-over
-  accounts are returned.
+  populates the OU-based tree, mapping account/OU to billing data.  the walk
+  visits every OU in the org, so the IDs of all accounts found along the way
+  are returned:  users in the bill but not in that set have left the org.
+
+  the tree is walked one level at a time, and the OU children and accounts
+  for every node on a level are fetched concurrently:  the walk is bound by
+  Organizations API round-trips, not CPU.
 
   args:
     tree:              root node object
     user_dict:         dict created from parsing billing file
     default_currency:  the default currency pulled from the billing CSV
-  """
-  current_node = tree
-  children = awslib.get_ou_children(current_node.id)
-  accounts = awslib.get_accounts_for_ou(current_node.id)
-
-  if accounts:
-    for account in accounts:
-      if account.id not in user_dict:
-        # account has zero spend and not showing up in the billing CSV
-        current_node.add_account(config.AccountInfo(
-          id=account.id,
-          name=account.name,
-          total=0.0,
-          currency=default_currency)
-        )
-      else:
-        current_node.add_account(config.AccountInfo(
-          id=account.id,
-          name=account.name,
-          total=user_dict[account.id]['total'],
-          currency=user_dict[account.id]['currency'])
-         )
-
-  if children is not None:
-    for child in children:
-      current_node.add_child(
-        id=child.id,
-        name=child.name,
-        currency=default_currency
-      )
-    for child in current_node.children:
-      populate_tree(
-        child,
-        user_dict,
-        default_currency
-      )
 
-def add_leavers(root, user_dict, default_currency):
+  returns:
+    org_accounts:  set of the AWS IDs of every account in the AWS org
+  """
+  level = [tree]
+  org_accounts = set()
+
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=OU_WORKERS)
+
+  with executor:
+    while level:
+      ou_ids = [node.id for node in level]
+      level_children = executor.map(awslib.get_ou_children, ou_ids)
+      level_accounts = executor.map(awslib.get_accounts_for_ou, ou_ids)
+      next_level = list()
+
+      for current_node, children, accounts in zip(level, level_children,
+                                                  level_accounts):
+        if accounts:
+          for account in accounts:
+            org_accounts.add(account.id)
+            if account.id not in user_dict:
+              # account has zero spend and not showing up in the billing CSV
+              current_node.add_account(config.AccountInfo(
+                id=account.id,
+                name=account.name,
+                total=0.0,
+                currency=default_currency)
+              )
+            else:
+              current_node.add_account(config.AccountInfo(
+                id=account.id,
+                name=account.name,
+                total=user_dict[account.id].total,
+                currency=user_dict[account.id].currency)
+               )
+
+        if children is not None:
+          for child in children:
+            next_level.append(current_node.add_child(
+              id=child.id,
+              name=child.name,
+              currency=default_currency
+            ))
+
+      level = next_level
+
+  return org_accounts
+
+def add_leavers(root, user_dict, default_currency, aws_accounts):
   """
   find AWS accounts that have spend in the billing CSV, but are not in the
   consolidated billing family.  create a top-level node containing these
@@ -146,27 +187,38 @@ def add_leavers(root, user_dict, default_currency):
     root:       the root Node of the entire OU tree
     user_dict:  the user dict generated from the billing CSV
     default_currency:  the default currency
+    aws_accounts:  set of AWS IDs in the org, as returned by populate_tree
   """
-  leavers_node_added = False
-  aws_accounts = awslib.get_accounts_for_org()
-
-  for id in user_dict.keys():
-    if id not in aws_accounts:
-      if not leavers_node_added:
-        leavers_node_added = True
-        leavers_node = root.add_child(id='leavers',
-                                      name='No Longer in AWS Organization',
-                                      currency=default_currency
-        )
-
-      leavers_node.add_account(config.AccountInfo(
-        id=id,
-        name=user_dict[id]['name'],
-        total=user_dict[id]['total'],
-        currency=user_dict[id]['currency'])
-      )
+  # iterate over the bill (rather than a set difference) to keep the order
+  # of the leavers stable between runs
+  leavers = [id for id in user_dict if id not in aws_accounts]
+
+  if leavers:
+    leavers_node = root.add_child(id='leavers',
+                                  name='No Longer in AWS Organization',
+                                  currency=default_currency
+    )
+
+    for id in leavers:
+      leavers_node.add_account(user_dict[id])
+
+def sort_accounts(user_dict):
+  """
+  flatten the billing data into a list of accounts, sorted by spend.  this
+  is done once per run and shared by every account-based report and CSV.
+
+  args:
+    user_dict:  dict of all users and individual total spends
+
+  returns:
+    list of (name, id, total, currency) tuples, highest spend first
+  """
+  account_details = [(u.name, u.id, u.total, u.currency)
+                     for u in user_dict.values()]
+
+  return sorted(account_details, key=operator.itemgetter(2), reverse=True)
 
-def generate_simple_csv(user_dict, outfile=None, limit=0.0,
+def generate_simple_csv(accounts, outfile=None, limit=0.0,
                         month=None, year=None):
   """
   output account-based spends to a CSV.  can create a new file, or append to an
@@ -182,132 +234,122 @@ def generate_simple_csv(user_dict, outfile=None, limit=0.0,
   projects, and may require tweaking for other types of orgs.
 
   args:
+    accounts: list of account tuples, as returned by sort_accounts()
     limit:    only print the OU spend that's greater than this
     outfile:  name of the CSV to write to.
     month:    month of the report (gleaned from the billing CSV)
     year:     year of the report (gleaned from the billing CSV)
   """
   CSV_HEADER = ['year', 'month', 'person', 'spend']
-  account_details = list()
   limit = float(limit) or 0.0
-  locale.setlocale(locale.LC_ALL, '')
 
   if os.path.isfile(outfile):
     append = True
   else:
     append = False
 
+  lines = list()
+
   # add the header to the CSV if we're creating it
   if append is False:
-    with open(outfile, 'w', newline='') as csv_file:
-      writer = csv.writer(csv_file, delimiter=',')
-      writer.writerow(CSV_HEADER)
+    lines.append(CSV_HEADER)
 
-  # for each user, get the OU that they are the member of
-  for id in user_dict.keys():
-    u = user_dict[id]
-    account_details.append((u['name'], id, u['total'], u['currency']))
-
-  for acct in sorted(account_details, key = lambda acct: acct[2], reverse = True):
+  for acct in accounts:
     (acct_name, acct_num, acct_total, acct_total_currency) = acct
 
+    # accounts are sorted by spend, so the rest are under the limit too
     if acct_total < limit:
-      continue
+      break
 
-    acct_total_str = locale.format("%.2f", acct_total, grouping=True)
-    acct_total_str = '$' + str(acct_total_str)
+    acct_total_str = f"${acct_total:,.2f}"
 
-    with open(outfile, 'a', newline='') as csv_file:
-      writer = csv.writer(csv_file, delimiter=',')
-      line = [year, month, acct_name, acct_total_str]
-      writer.writerow(line)
+    line = [year, month, acct_name, acct_total_str]
+    lines.append(line)
 
-def generate_leaderboard(user_dict, display_ids, top, default_currency):
+  with open(outfile, 'a', newline='') as csv_file:
+    writer = csv.writer(csv_file, delimiter=',')
+    writer.writerows(lines)
+
+def generate_leaderboard(accounts, display_ids, top, default_currency):
   """
   list top N spenders
 
   args:
-    user_dict:         dict of all users and individual total spends
+    accounts:          list of account tuples, as returned by sort_accounts()
     display_ids:       display each user's AWS ID after their name
     default_currency:  default currency
     top_users:         limit output to N top users.  if 0, print all.
   """
-  total_spend = 0
-  report = ''
-  account_details = list()
-  top_spenders = list()
-
-  # for each user, get the OU that they are the member of
-  for id in user_dict.keys():
-    u = user_dict[id]
-    account_details.append((u['name'], id, u['total'], u['currency']))
+  report = list()
 
-  top_spenders = sorted(account_details, key = lambda acct: acct[2], reverse = True)[:top]
-  total_spend = sum([x[2] for x in top_spenders])
+  top_spenders = accounts[:top]
+  total_spend = math.fsum(acct[2] for acct in top_spenders)
 
-  sum_str = locale.format('%.2f', total_spend, grouping=True)
-  report = "== AWS top %s leaderboard:  $%s %s ==\n\n" \
-           % (top, sum_str, default_currency)
+  sum_str = f"{total_spend:,.2f}"
+  report.append(f"== AWS top {top} leaderboard:  ${sum_str} "
+                f"{default_currency} ==\n\n")
 
   for acct in top_spenders:
     (acct_name, acct_num, acct_total, acct_total_currency) = acct
 
-    acct_total_str = locale.format("%.2f", acct_total, grouping=True)
+    acct_total_str = f"{acct_total:,.2f}"
     if display_ids:
-      report = report + "{:<25}\t({})\t{} {}\n".format(acct_name, acct_num,
-                                                       acct_total_str,
-                                                       acct_total_currency)
+      report.append(f"{acct_name:<25}\t({acct_num})\t{acct_total_str} "
+                    f"{acct_total_currency}\n")
     else:
-      report = report + "{:<25}\t\t${} {}\n".format(acct_name,
-                                                    acct_total_str,
-                                                    acct_total_currency)
+      report.append(f"{acct_name:<25}\t\t${acct_total_str} "
+                    f"{acct_total_currency}\n")
 
-  report = report + "\n\n"
+  report.append("\n\n")
 
-  return report
+  return ''.join(report)
 
-def generate_simple_report(user_dict, limit, display_ids, default_currency):
+def generate_totals_header(total_spend, limit, default_currency):
+  """
+  generate the header line with the overall spend, shared by the simple and
+  OU-based reports.
+
+  args:
+    total_spend:       total spend for all accounts
+    limit:             the display limit used for the report body
+    default_currency:  default currency
+  """
+  return f"== Current AWS totals:  ${total_spend:,.2f} {default_currency} " \
+         f"(only shown below: > ${limit}) ==\n\n"
+
+def generate_simple_report(accounts, limit, display_ids, default_currency):
   """
   generate the billing report, categorized by OU.
 
   args:
-    user_dict:         dict of all users and individual total spends
+    accounts:          list of account tuples, as returned by sort_accounts()
     limit:             display only amounts greater then this in the report.
                        default is 0 (all accounts shown)
     display_ids:       display each user's AWS ID after their name
     default_currency:  default currency
   """
-  total_spend = 0
-  report = ''
-  account_details = list()
+  report = list()
 
-  # for each user, get the OU that they are the member of
-  for id in user_dict.keys():
-    u = user_dict[id]
-    total_spend = total_spend + u['total']
-    account_details.append((u['name'], id, u['total'], u['currency']))
+  total_spend = math.fsum(acct[2] for acct in accounts)
 
-  sum_str = locale.format('%.2f', total_spend, grouping=True)
-  report = "== Current AWS totals:  $%s %s (only shown below: > $%s) ==\n\n" \
-           % (sum_str, default_currency, limit)
+  report.append(generate_totals_header(total_spend, limit, default_currency))
 
-  for acct in sorted(account_details, key = lambda acct: acct[2], reverse = True):
+  for acct in accounts:
     (acct_name, acct_num, acct_total, acct_total_currency) = acct
 
+    # accounts are sorted by spend, so the rest are under the limit too
     if acct_total < limit:
-      continue
+      break
 
-    acct_total_str = locale.format("%.2f", acct_total, grouping=True)
+    acct_total_str = f"{acct_total:,.2f}"
     if display_ids:
-      report = report + "{:<25}\t({})\t{} {}\n".format(acct_name, acct_num,
-                                                       acct_total_str,
-                                                       acct_total_currency)
+      report.append(f"{acct_name:<25}\t({acct_num})\t{acct_total_str} "
+                    f"{acct_total_currency}\n")
     else:
-      report = report + "{:<25}\t\t${} {}\n".format(acct_name,
-                                                    acct_total_str,
-                                                    acct_total_currency)
+      report.append(f"{acct_name:<25}\t\t${acct_total_str} "
+                    f"{acct_total_currency}\n")
 
-  return report
+  return ''.join(report)
 
 def create_plots(acctcsv=None, orgcsv=None):
   """
@@ -334,30 +376,65 @@ def create_plots(acctcsv=None, orgcsv=None):
 
   return account_plot, org_plot
 
-def send_email(report, weekly, plots):
+@contextlib.contextmanager
+def smtp_session():
+  """
+  open a connection to the mail server defined in emailsettings.py, and
+  close it (QUIT) when done.  the connection can be handed to send_email()
+  to send several reports over a single session.
+
+  returns:
+    connected smtplib.SMTP object
+  """
+  import smtplib
+
+  # retry the connect and greeting once if the server refuses, times out or
+  # drops the connection (smtplib's errors are all OSErrors).  nothing has
+  # been sent yet at this point, so retrying can't deliver the report twice.
+  for attempt in range(2):
+    s = smtplib.SMTP(timeout=SMTP_TIMEOUT)
+    try:
+      s.connect(emailsettings.MAIL_SERVER)
+      # falls back to HELO for servers that reject EHLO
+      s.ehlo_or_helo_if_needed()
+      break
+    except OSError:
+      s.close()
+      if attempt:
+        raise
+
+  with s:
+    yield s
+
+def send_email(report, weekly, plots, smtp_client=None):
   """
   send the report as an email, with the to:, from:, subject: and preamble
   defined in emailsettings.py.
 
   args:
-    report:  the raw string containing the final report
-    weekly:  boolean, if true use weekly email formatting.  if false, use
-               monthly.
-    plots:   a tuple of plot file locations to attach to the email
+    report:       the raw string containing the final report
+    weekly:       boolean, if true use weekly email formatting.  if false, use
+                    monthly.
+    plots:        a tuple of plot file locations to attach to the email
+    smtp_client:  an already connected smtplib.SMTP object (see
+                    smtp_session()) to send with.  if none is given, a
+                    connection is opened (and closed) just for this email.
   """
-  account_plot, org_plot = plots
+  # only needed when mailing the report, so don't load them on every run
+  from email.mime.text import MIMEText
+  from email.mime.image import MIMEImage
+  from email.mime.multipart import MIMEMultipart
 
   if weekly:
     subject = emailsettings.EMAIL_SUBJECT_WEEKLY
-    preamble = emailsettings.EMAIL_PREAMBLE_WEEKLY + \
-               emailsettings.EMAIL_PREAMBLE
+    intro = emailsettings.EMAIL_PREAMBLE_WEEKLY
   else:
     subject = emailsettings.EMAIL_SUBJECT_MONTHLY
-    preamble = emailsettings.EMAIL_PREAMBLE_MONTHLY + \
-               emailsettings.EMAIL_PREAMBLE
+    intro = emailsettings.EMAIL_PREAMBLE_MONTHLY
 
-  report = preamble + report + "\n\n---\nSent from %s.\n" % \
-           (socket.gethostname())
+  # assemble the body in one go rather than copying the report for each '+'
+  footer = f"\n\n---\nSent from {socket.gethostname()}.\n"
+  report = ''.join((intro, emailsettings.EMAIL_PREAMBLE, report, footer))
   message_body = MIMEText(report)
 
   msg = MIMEMultipart()
@@ -366,20 +443,24 @@ def send_email(report, weekly, plots):
   msg['To'] = emailsettings.EMAIL_TO_ADDR
   msg.attach(message_body)
 
-  if account_plot:
-    img_data = open(account_plot, 'rb').read()
-    image = MIMEImage(img_data, name=os.path.basename(account_plot))
-    msg.attach(image)
+  for plot in plots:
+    if plot:
+      with open(plot, 'rb') as img_file:
+        image = MIMEImage(img_file.read(), name=os.path.basename(plot))
+      msg.attach(image)
+
+  msg = msg.as_string()
 
-  if org_plot:
-    img_data = open(org_plot, 'rb').read()
-    image = MIMEImage(img_data, name=os.path.basename(org_plot))
-    msg.attach(image)
+  if smtp_client is not None:
+    smtp_client.sendmail(emailsettings.EMAIL_FROM_ADDR,
+                         [emailsettings.EMAIL_TO_ADDR],
+                         msg)
+    return
 
-  s = smtplib.SMTP(emailsettings.MAIL_SERVER)
-  s.sendmail(emailsettings.EMAIL_FROM_ADDR,
-             [emailsettings.EMAIL_TO_ADDR],
-             msg.as_string())
+  with smtp_session() as s:
+    s.sendmail(emailsettings.EMAIL_FROM_ADDR,
+               [emailsettings.EMAIL_TO_ADDR],
+               msg)
 
 def parse_args():
   desc = """
@@ -412,7 +493,7 @@ S3 billing bucket name.  Required unless using the --local argument.
                       "--local",
                       help="""
 Read a consolidated billing CSV from the filesystem and bypass
-downloading from S3.
+downloading from S3.  Files ending in .gz are decompressed on the fly.
                       """,
                       type=str,
                       metavar="LOCAL_BILLING_CSV")
@@ -555,7 +636,7 @@ def main():
           " --orgcsv options.")
     sys.exit(-1)
 
-  report = ''
+  report_parts = list()
   billing_data = awslib.get_latest_bill(
     args.id,
     args.bucket,
@@ -564,58 +645,64 @@ def main():
   )
   user_dict, currency, month, year = parse_billing_data(billing_data)
 
+  # an empty or truncated bill would otherwise produce (and mail) a $0.00
+  # report
+  if not user_dict:
+    if args.local:
+      print("unable to find billing data in %s!" % args.local)
+    else:
+      print("unable to find billing data (%s) in your bucket!" % \
+            awslib.get_billing_filename(args.id))
+    sys.exit(-1)
+  accounts = sort_accounts(user_dict)
+
   # leaderboard?
   if args.top != 0:
-    report = generate_leaderboard(
-      user_dict,
+    report_parts.append(generate_leaderboard(
+      accounts,
       args.display_ids,
       args.top,
       currency
-    )
+    ))
 
   # no OU tree, just spew out the report
   if not args.ou:
-    report = report + generate_simple_report(
-      user_dict,
+    report_parts.append(generate_simple_report(
+      accounts,
       args.limit,
       args.display_ids,
       currency
-    )
+    ))
 
   # use the OU tree, more complex report
   else:
     root = init_tree(args.id, currency)
-    populate_tree(root, user_dict, currency)
+    org_accounts = populate_tree(root, user_dict, currency)
 
     # handle those who have left the org, but are in the billing CSV.
-    add_leavers(root, user_dict, currency)
-
-    sum_str = locale.format('%.2f', root.node_spend, grouping=True)
-    report = report + \
-           '== Current AWS totals:  $%s %s (only shown below: > $%s) ==\n\n' \
-           % (sum_str, currency, args.limit)
+    add_leavers(root, user_dict, currency, org_accounts)
+    root.finalize_spend()
 
-    old_stdout = sys.stdout
-    tree_output = StringIO()
-    sys.stdout = tree_output
+    report_parts.append(generate_totals_header(root.node_spend, args.limit,
+                                               currency))
 
-    root.print_tree(limit=args.limit, display_ids=args.display_ids)
-
-    sys.stdout = old_stdout
-    report = report + tree_output.getvalue()
+    report_parts.append(root.format_tree(limit=args.limit,
+                                         display_ids=args.display_ids))
 
     # add the basic report to the end if desired
     if args.full:
-      report = report + '\n\n'
-      report = report + generate_simple_report(
-        user_dict,
+      report_parts.append('\n\n')
+      report_parts.append(generate_simple_report(
+        accounts,
         args.limit,
         args.display_ids,
         currency
-      )
+      ))
+
+  report = ''.join(report_parts)
 
   if args.csv:
-    generate_simple_csv(user_dict, outfile=args.csv, month=month, year=year)
+    generate_simple_csv(accounts, outfile=args.csv, month=month, year=year)
 
   if args.orgcsv:
     root.generate_project_csv(outfile=args.orgcsv, month=month, year=year)
@@ -631,4 +718,4 @@ def main():
     send_email(report, args.weekly, (account_plot, org_plot))
 
 if __name__ == "__main__":
-  main()
+  sys.exit(main())
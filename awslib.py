@@ -1,7 +1,77 @@
-import boto3
 import config
-import csv
+import contextlib
 import datetime
+import functools
+import gzip
+import shutil
+import sys
+
+# retry settings for the organizations client, which is shared between the
+# threads walking the OU tree
+ORG_CLIENT_RETRIES = {'max_attempts': 10, 'mode': 'adaptive'}
+
+# ask for the largest page the Organizations list calls allow (20), to keep
+# the number of round-trips per OU down
+ORG_PAGINATION = {'PageSize': 20}
+
+# read size used when pulling the billing CSV from S3
+S3_CHUNK_SIZE = 1024 * 1024
+
+@functools.lru_cache(maxsize=1)
+def _session():
+  """
+  get the boto3 session that all clients are built from, so credentials are
+  resolved and service models are loaded once for the whole run.  boto3 is
+  only imported here, so runs against a --local bill don't pay for it.
+
+  returns:
+    boto3 session
+  """
+  import boto3
+
+  return boto3.session.Session()
+
+@functools.lru_cache(maxsize=1)
+def _s3_client():
+  """
+  get the (shared) boto3 S3 client.
+
+  returns:
+    boto3 S3 client
+  """
+  return _session().client('s3')
+
+@functools.lru_cache(maxsize=1)
+def _org_client():
+  """
+  get the (shared) boto3 organizations client.  building a client loads the
+  service model and walks the credential chain, so only do that once per run.
+  the client is used from several threads while walking the OU tree, so let
+  botocore back off adaptively when the Organizations API throttles us.
+
+  returns:
+    boto3 organizations client
+  """
+  from botocore.config import Config
+
+  return _session().client('organizations',
+                           config=Config(retries=ORG_CLIENT_RETRIES))
+
+def get_billing_filename(aws_id):
+  """
+  get the name of this month's consolidated billing CSV in the billing bucket
+
+  args:
+    aws_id:  AWS account number
+
+  returns:
+    billing_filename:  name of the billing CSV
+  """
+  today = datetime.date.today()
+  month = today.strftime('%m')
+  year = today.strftime('%Y')
+
+  return aws_id + '-aws-billing-csv-' + year + '-' + month + '.csv'
 
 def get_latest_bill(aws_id, billing_bucket, billing_file_path, save):
   """
@@ -10,37 +80,46 @@ def get_latest_bill(aws_id, billing_bucket, billing_file_path, save):
     aws_id:             AWS account number
     billing_bucket:     name of the billing bucket
     billing_file_path:  full path to consolidated billing file on a local
-                        FS (optional)
+                        FS (optional).  files ending in .gz are read as
+                        gzip-compressed CSVs.
     save:               save the CSV to disk with the default filename
 
   returns:
-    csv object of billing data
+    generator of the raw (utf-8 encoded bytes) lines of the billing CSV.  the
+    file or S3 stream is closed once the lines have been consumed.
   """
   if billing_file_path:
-    f = open(billing_file_path, 'r')
-    billing_data = f.read()
+    if billing_file_path.endswith('.gz'):
+      # archived bills are often gzipped, and decompress as they're read
+      billing_file = gzip.open(billing_file_path, 'rb')
+    else:
+      billing_file = open(billing_file_path, 'rb')
+    billing_data = billing_file
   else:
-    today = datetime.date.today()
-    month = today.strftime('%m')
-    year = today.strftime('%Y')
-    billing_filename =  aws_id + '-aws-billing-csv-' + \
-                        year + '-' + month + '.csv'
-
-    s3 = boto3.resource('s3')
-    b = s3.Object(billing_bucket, billing_filename)
-    billing_data = b.get()['Body'].read().decode('utf-8')
+    billing_filename = get_billing_filename(aws_id)
 
-    if not billing_data:
+    s3 = _s3_client()
+    try:
+      body = s3.get_object(Bucket=billing_bucket, Key=billing_filename)['Body']
+    except s3.exceptions.NoSuchKey:
       print("unable to find billing data (%s) in your bucket!" % \
             billing_filename)
       sys.exit(-1)
 
-  if (save):
-    f = open(billing_filename, 'w')
-    f.write(billing_data)
-    f.close
+    if (save):
+      with contextlib.closing(body), open(billing_filename, 'wb') as f:
+        shutil.copyfileobj(body, f, S3_CHUNK_SIZE)
+      billing_file = open(billing_filename, 'rb')
+      billing_data = billing_file
+    else:
+      # split lines as the body streams in, rather than buffering the whole
+      # bill.  large reads keep the number of socket reads per bill small.
+      billing_file = body
+      billing_data = body.iter_lines(chunk_size=S3_CHUNK_SIZE)
 
-  return csv.reader(billing_data.split('\n'))
+  # closing the body also hands the HTTP connection back to the pool
+  with contextlib.closing(billing_file):
+    yield from billing_data
 
 def get_root_ou_id(aws_id):
   """
@@ -52,7 +131,7 @@ def get_root_ou_id(aws_id):
   returns:
     namedtuple (id, name) with ID number of the ROOT OU and 'ROOT'
   """
-  client = boto3.client('organizations')
+  client = _org_client()
   ou_r = client.list_roots()
 
   return config.NodeInfo(id=ou_r['Roots'][0]['Id'], name='ROOT')
@@ -68,21 +147,15 @@ def get_ou_children(ou_id):
     children:  list of NodeInfo namedtuples or NoneType if no children OUs are
                present
   """
-  client = boto3.client('organizations')
-  ou_r = client.list_organizational_units_for_parent(ParentId=ou_id)
+  client = _org_client()
+  paginator = client.get_paginator('list_organizational_units_for_parent')
 
   children = list()
-
-  while True:
-    for ou in ou_r['OrganizationalUnits']:
+  for page in paginator.paginate(ParentId=ou_id,
+                                 PaginationConfig=ORG_PAGINATION):
+    for ou in page['OrganizationalUnits']:
       children.append(config.NodeInfo(id=ou['Id'], name=ou['Name']))
 
-    if 'NextToken' in ou_r:
-      ou_r = client.list_organizational_units_for_parent(
-        ParentId=ou_id, NextToken=ou_r['NextToken'])
-    else:
-      break
-
   return children or None
 
 def get_accounts_for_ou(ou_id):
@@ -95,40 +168,13 @@ def get_accounts_for_ou(ou_id):
   returns:
     accounts:  list of namedtuples with AWS ID and full name
   """
-  client = boto3.client('organizations')
-  ou_r = client.list_accounts_for_parent(ParentId=ou_id)
+  client = _org_client()
+  paginator = client.get_paginator('list_accounts_for_parent')
 
   accounts = list()
-  while True:
-    for acct in ou_r['Accounts']:
+  for page in paginator.paginate(ParentId=ou_id,
+                                 PaginationConfig=ORG_PAGINATION):
+    for acct in page['Accounts']:
       accounts.append(config.Account(id=acct['Id'], name=acct['Name']))
 
-    if 'NextToken' in ou_r:
-      ou_r = client.list_accounts_for_parent(ParentId=ou_id,
-                                             NextToken=ou_r['NextToken'])
-    else:
-      break
-
   return accounts or None
-
-def get_accounts_for_org():
-  """
-  get a list of all accounts in the AWS org
-
-  returns:
-    aws_accounts:  a list of AWS account IDs
-  """
-  aws_accounts = list()
-  client = boto3.client('organizations')
-  ou_r = client.list_accounts()
-
-  while True:
-    for acct in ou_r['Accounts']:
-      aws_accounts.append(acct['Id'])
-
-    if 'NextToken' in ou_r:
-      ou_r = client.list_accounts(NextToken=ou_r['NextToken'])
-    else:
-      break
-
-  return aws_accounts
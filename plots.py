@@ -2,7 +2,6 @@ import matplotlib
 matplotlib.use('Agg')  # (ノಠ益ಠ)ノ彡┻━┻
 import pandas as pd
 import matplotlib.pyplot as plt
-import re
 import sys
 
 def account_spend_plot(csvfile=None, outputfilename=None, outputfiletype="png"):
@@ -24,10 +23,11 @@ def account_spend_plot(csvfile=None, outputfilename=None, outputfiletype="png"):
   else:
     outfile = outputfilename + '.' + outputfiletype
 
-  indv = pd.read_csv(csvfile)
-  indv['spend'] = indv['spend'].str.replace(re.compile(",|\$"), "").astype(float)
+  indv = pd.read_csv(csvfile, usecols=['person', 'spend'])
+  indv['spend'] = indv['spend'].str.replace(',', '', regex=False) \
+                               .str.replace('$', '', regex=False).astype(float)
 
-  indv.groupby('person')['spend'].sum().sort_values(ascending=False).head(20).plot(kind='bar')
+  indv.groupby('person')['spend'].sum().nlargest(20).plot(kind='bar')
   plt.savefig(outfile, bbox_inches='tight')
 
   return outfile
@@ -51,10 +51,11 @@ def org_spend_plot(csvfile=None, outputfilename=None, outputfiletype="png"):
   else:
     outfile = outputfilename + '.' + outputfiletype
 
-  proj = pd.read_csv(csvfile)
-  proj['spend'] = proj['spend'].str.replace(re.compile(",|\$"), "").astype(float)
+  proj = pd.read_csv(csvfile, usecols=['project', 'spend'])
+  proj['spend'] = proj['spend'].str.replace(',', '', regex=False) \
+                               .str.replace('$', '', regex=False).astype(float)
 
-  proj.groupby('project')['spend'].sum().sort_values(ascending=False).head(20).plot(kind='bar')
+  proj.groupby('project')['spend'].sum().nlargest(20).plot(kind='bar')
   plt.savefig(outfile, bbox_inches='tight')
 
   return outfile
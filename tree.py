@@ -3,34 +3,44 @@ inspiration from:
 https://github.com/lianemeth/forest/blob/master/forest/NaryTree.py
 """
 import csv
-import locale
+import operator
 import os
 import sys
-import weakref
 
 class Node(object):
   """
   an n-ary tree implementation to store AWS OU and account information
+
+  a node's node_spend only includes the spend of the nodes below it once
+  finalize_spend() has been run on the tree.  render(), format_tree(),
+  print_tree() and generate_project_csv() run it themselves when needed,
+  but anything else reading node_spend must call it first.
   """
+  # one Node per OU, so skip the per-instance __dict__
+  __slots__ = ('id', 'name', 'node_spend', 'node_account_spend', 'accounts',
+               'children', 'currency', 'parent', '_parent_path',
+               '_sorted_accounts', '_finalized')
+
   def __init__(self, id=None, name=None, children=None, accounts=None,
                node_spend=0, node_account_spend=0, parent=None, currency=None):
       self.id = id
-      self.node_spend = float(node_spend) or float(0)
-      self.node_account_spend = float(node_account_spend) or float(0)
+      self.node_spend = float(node_spend)
+      self.node_account_spend = float(node_account_spend)
       self.accounts = accounts or []
       self.children = children or []
       self.currency = currency or None
-      self._parent = weakref.ref(parent) if parent else None
-      if self._parent is None:
+      # the whole tree lives for the length of the run, so a plain
+      # reference back to the parent is fine
+      self.parent = parent
+      self._parent_path = None
+      self._sorted_accounts = None
+      # True while node_spend includes everything below this node
+      self._finalized = True
+      if self.parent is None:
         self.name = "ROOT"
       else:
         self.name = name
 
-  @property
-  def parent(self):
-    if self._parent:
-      return self._parent()
-
   def __iter__(self):
     yield self
     for child in self.children:
@@ -55,7 +65,9 @@ class Node(object):
   def add_account(self, account=None):
     """
     adds an AWS account to the leaf of the tree and adds the account spend
-    to the node spend (as well as adding up to the root node)
+    to the node spend.  the spend is only rolled up to the parent nodes by
+    finalize_spend(), once the tree is complete, so the parents are marked
+    as needing it.
 
     args:
       account: tuple of (account id, real name, account spend, currency)
@@ -64,18 +76,64 @@ class Node(object):
       account: tuple of (account id, real name, account spend, currency)
     """
     self.accounts.append(account)
+    self._sorted_accounts = None
     self.node_spend = self.node_spend + account.total
     self.node_account_spend = self.node_account_spend + account.total
-    parent = self.parent
-    while parent is not None:
-      parent.node_spend = parent.node_spend + account.total
-      parent = parent.parent
+
+    # stop at the first ancestor that is already marked, as everything above
+    # it is too
+    node = self.parent
+    while node is not None and node._finalized:
+      node._finalized = False
+      node = node.parent
 
     return account
 
+  def finalize_spend(self):
+    """
+    roll the account spend up the tree, so that each node's spend includes
+    the spend of all of its children.  call this once, after all of the
+    accounts have been added.  render() and generate_project_csv() call it
+    themselves if the tree has changed since.
+
+    args:
+      none
+
+    returns:
+      node_spend:  total spend for this node and everything below it
+    """
+    # list every node top-down (the list grows as it is walked), then sum
+    # bottom-up so each child is done before its parent
+    nodes = [self]
+    for node in nodes:
+      nodes.extend(node.children)
+
+    for node in reversed(nodes):
+      node.node_spend = node.node_account_spend
+      for child in node.children:
+        node.node_spend = node.node_spend + child.node_spend
+      node._finalized = True
+
+    return self.node_spend
+
   def get_accounts(self):
     return self.accounts
 
+  def get_sorted_accounts(self):
+    """
+    get the accounts attached to this node, highest spend first.  the sorted
+    list is cached until another account is added.
+
+    returns:
+      list of account tuples, sorted by spend
+    """
+    if self._sorted_accounts is None:
+      self._sorted_accounts = sorted(self.accounts,
+                                     key=operator.attrgetter('total'),
+                                     reverse=True)
+
+    return self._sorted_accounts
+
   def get_children(self):
     return self.children
 
@@ -87,19 +145,19 @@ class Node(object):
       none
 
     returns:
-      parent_path:  list containing path from root to the current node
+      parent_path:  list containing path from root to the current node.  the
+                    list is cached on the node (the tree isn't re-parented),
+                    so don't modify it.
     """
     if self.parent is None:
       return
 
-    parent = self.parent
-    parent_path = [parent.name]
-    while parent.parent is not None:
-      parent = parent.parent
-      parent_path.append(parent.name)
+    # build on the parent's (cached) path rather than walking up to the root
+    if self._parent_path is None:
+      parent = self.parent
+      self._parent_path = (parent.get_parent_path() or []) + [parent.name]
 
-    parent_path.reverse()
-    return parent_path
+    return self._parent_path
 
   def print_tree(self, limit=0.0, display_ids=None):
     """
@@ -109,43 +167,76 @@ class Node(object):
       limit:       float of the minimum amount to display
       display_ids: flag to display the AWS ID after the name
 
+    returns:
+      none
+    """
+    sys.stdout.write(self.format_tree(limit=limit, display_ids=display_ids))
+
+  def format_tree(self, limit=0.0, display_ids=None):
+    """
+    returns the tree, including some formatting, as a single string
+
+    args:
+      limit:       float of the minimum amount to display
+      display_ids: flag to display the AWS ID after the name
+
+    returns:
+      string containing the formatted tree
+    """
+    buf = list()
+    self.render(buf, limit=limit, display_ids=display_ids)
+    return ''.join(buf)
+
+  def render(self, buf, limit=0.0, display_ids=None):
+    """
+    renders the tree, including some formatting, by appending the lines of
+    output (newline terminated) to buf
+
+    args:
+      buf:         list to append the output to
+      limit:       float of the minimum amount to display
+      display_ids: flag to display the AWS ID after the name
+
     returns:
       none
     """
     limit = float(limit) or 0.0
-    locale.setlocale(locale.LC_ALL, '')
-    node_spend = locale.format('%.2f', self.node_spend, grouping=True)
-    node_spend = '$' + str(node_spend)
-    name = self.name + ':'
-
-    if self.parent is not None:
-      parent_path = self.get_parent_path()
-      parent_path = ' -> '.join(parent_path)
-      print(parent_path, '->', name, node_spend, self.currency)
-      print('==========')
-    else:
-      print(name, node_spend, self.currency)
-
-    for account in sorted(self.get_accounts(),
-                          key = lambda account: account.total,
-                          reverse = True):
-      if account.total >= limit:
-        account_spend = locale.format('%.2f', account.total, grouping=True)
-        account_spend = '$' + str(account_spend)
+
+    if not self._finalized:
+      self.finalize_spend()
+
+    # walk the tree depth-first with an explicit stack, pushing the children
+    # in reverse so they come back off in order
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      node_spend = f"${node.node_spend:,.2f}"
+      name = node.name + ':'
+
+      if node.parent is not None:
+        parent_path = node.get_parent_path()
+        parent_path = ' -> '.join(parent_path)
+        buf.append(f"{parent_path} -> {name} {node_spend} {node.currency}\n")
+        buf.append('==========\n')
+      else:
+        buf.append(f"{name} {node_spend} {node.currency}\n")
+
+      for account in node.get_sorted_accounts():
+        # the accounts are sorted by spend, so the rest are under the limit
+        if account.total < limit:
+          break
+
+        account_spend = f"${account.total:,.2f}"
         if display_ids:
-          print('{:25}\t({})\t{} {}'.format(account.name,
-                                            account.id,
-                                            account_spend,
-                                            account.currency))
+          buf.append(f"{account.name:25}\t({account.id})\t{account_spend} "
+                     f"{account.currency}\n")
         else:
-          print('{:25}\t\t{} {}'.format(account.name,
-                                        account_spend,
-                                        account.currency))
+          buf.append(f"{account.name:25}\t\t{account_spend} "
+                     f"{account.currency}\n")
 
-    print()
+      buf.append('\n')
 
-    for child in self.children:
-      child.print_tree(limit, display_ids)
+      stack.extend(reversed(node.children))
 
   def generate_project_csv(self, limit=0.0, outfile=None, month=None,
                            year=None):
@@ -181,48 +272,61 @@ class Node(object):
       append = False
 
     limit = float(limit) or 0.0
-    locale.setlocale(locale.LC_ALL, '')
-    formatted_spend = locale.format('%.2f', self.node_account_spend,
-                                    grouping=True)
-    formatted_spend = '$' + str(formatted_spend)
+    lines = list()
+
+    if not self._finalized:
+      self.finalize_spend()
 
     # add the header to the CSV if we're creating it
     if append is False:
-      with open(outfile, 'w', newline='') as csv_file:
-        writer = csv.writer(csv_file, delimiter=',')
-        writer.writerow(CSV_HEADER)
+      lines.append(CSV_HEADER)
+
+    self.project_csv_lines(lines, limit=limit, month=month, year=year)
+
+    with open(outfile, 'a', newline='') as csv_file:
+      writer = csv.writer(csv_file, delimiter=',')
+      writer.writerows(lines)
 
+  def project_csv_lines(self, lines, limit=0.0, month=None, year=None):
+    """
+    collect the ou-based spend lines for this node and its children, in tree
+    order.  see generate_project_csv() for the fields.
+
+    args:
+      lines:    list to append the CSV lines to
+      limit:    only print the OU spend that's greater than this
+      month:    month of the report (gleaned from the billing CSV)
+      year:     year of the report (gleaned from the billing CSV)
+    """
     if self.node_account_spend > limit:
+      formatted_spend = f"${self.node_account_spend:,.2f}"
+
       if self.parent is None:
-        with open(outfile, 'a', newline='') as csv_file:
-          writer = csv.writer(csv_file, delimiter=',')
-          line = [
-            year,
-            month,
-            self.name,
-            self.name,
-            formatted_spend,
-            len(self.accounts)
-          ]
-          writer.writerow(line)
+        line = [
+          year,
+          month,
+          self.name,
+          self.name,
+          formatted_spend,
+          len(self.accounts)
+        ]
+        lines.append(line)
 
       else:
-        with open(outfile, 'a', newline='') as csv_file:
-          writer = csv.writer(csv_file, delimiter=',')
-          line = [
-            year,
-            month,
-            self.parent.name,
-            self.name,
-            formatted_spend,
-            len(self.accounts)
-          ]
-          writer.writerow(line)
+        line = [
+          year,
+          month,
+          self.parent.name,
+          self.name,
+          formatted_spend,
+          len(self.accounts)
+        ]
+        lines.append(line)
 
     for child in self.children:
-      child.generate_project_csv(
+      child.project_csv_lines(
+        lines,
         limit=limit,
-        outfile=outfile,
         month=month,
         year=year
       )